@@ -1,38 +1,146 @@
 # app.py
 # Stable version before Phase 3 (spinner working, playlist saving correctly)
 
+import hashlib
+import logging
 import os
 import random
+import sys
+import threading
 import time
-from datetime import date
-from flask import Flask, request, redirect, session, url_for, render_template_string, flash
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
+from urllib.parse import quote
+from cachelib import FileSystemCache
+from flask import Flask, Response, g, jsonify, request, redirect, session, url_for, render_template, stream_template, flash
+from flask_caching import Cache
+from flask_session import Session
+import orjson
+import redis
+import requests
 import spotipy
+from spotipy.cache_handler import CacheHandler, FlaskSessionCacheHandler
 from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
+from zoneinfo import ZoneInfo
 
 # ---------- Configuration ----------
 SPOTIPY_CLIENT_ID = os.environ.get("SPOTIPY_CLIENT_ID")
 SPOTIPY_CLIENT_SECRET = os.environ.get("SPOTIPY_CLIENT_SECRET")
 SPOTIPY_REDIRECT_URI = os.environ.get("SPOTIPY_REDIRECT_URI")  # e.g., https://random-playlist.onrender.com/callback
 SCOPE = "user-library-read playlist-modify-private playlist-modify-public"
+SHARE_EMAIL_SUBJECT = quote("My Spotify Playlist 🎧")
+LOCAL_TZ = ZoneInfo(os.environ.get("APP_TZ", "America/New_York"))  # used for the suggested playlist date
 
 SECRET_KEY = os.environ.get("SECRET_KEY", os.urandom(24))
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
-LIKED_SONGS_CACHE = []
-CACHED_RANDOM_BATCH = None
-CACHED_RANDOM_TIMESTAMP = 0
+REDIS_URL = os.environ.get("REDIS_URL")
+
+# Server-side sessions: the cookie only carries a session id, while the token
+# and preview track ids stay in Redis (or on local disk without REDIS_URL).
+app.config["SESSION_PERMANENT"] = False
+if REDIS_URL:
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.from_url(REDIS_URL)
+else:
+    app.config["SESSION_TYPE"] = "cachelib"
+    app.config["SESSION_CACHELIB"] = FileSystemCache(".flask_session")
+Session(app)
+
+# Per-user liked songs, shared by all workers: Redis when REDIS_URL is set,
+# otherwise files on local disk so the cache still survives restarts.
+# "<user_id>:liked_tracks" -> {"total", "checked_at", "tracks": {position: Track},
+#                            "unique_window": [positions, one per artist], "window_at"}
+if REDIS_URL:
+    cache = Cache(app, config={"CACHE_TYPE": "RedisCache", "CACHE_REDIS_URL": REDIS_URL})
+else:
+    cache = Cache(app, config={"CACHE_TYPE": "FileSystemCache", "CACHE_DIR": ".liked_songs_cache"})
+LIKED_SONGS_CACHE_TIMEOUT = 24 * 60 * 60  # positions stay valid until the library total changes
 CACHE_EXPIRY_SECONDS = 60  # 1 minute cache
+STALE_WINDOW_SECONDS = 600  # an older batch is still served while a new one loads
+REFRESH_LOCKS = {}  # job key -> lock held while that background job runs; dropped when it ends
+PAGE_SIZE = 50  # Spotify's max page size for saved tracks
+FETCH_WORKERS = 5  # concurrent page requests, kept low to avoid 429s
+BACKGROUND_FILL_INTERVAL = 0.25  # seconds between whole-library pages; leaves most of the rate limit to previews
+SAMPLE_BY_POSITION_MAX = 20  # previews this small fetch single random tracks instead of a window
+SAMPLE_ROUNDS = 3  # extra draws to replace sampled tracks by an already-picked artist
+MAX_RETRIES = 5  # retries for a rate-limited (429) Spotify call
+MAX_BACKOFF_SECONDS = 30  # cap for the exponential backoff between retries
+SPOTIFY_POOL_SIZE = 32  # kept-alive connections per host; covers the fetch pool plus concurrent requests
+SAVE_STATUS_SECONDS = 60 * 60  # upper bound on a save, and how long its outcome stays readable
+
+# One pooled, keep-alive HTTP session shared by every Spotify client so
+# requests reuse TLS connections instead of opening a new pool per client.
+# The transport retries 5xx blips on reads only: a 5xx can arrive after Spotify
+# already applied a write, and resending a create, an add or a single-use
+# authorization code would duplicate it. 429s are left to call_spotify so a
+# long Retry-After is capped instead of blocking inside urllib3.
+SPOTIFY_SESSION = requests.Session()
+SPOTIFY_SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=SPOTIFY_POOL_SIZE,
+    max_retries=Retry(total=5, read=False, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504),
+                      respect_retry_after_header=False,
+                      raise_on_status=False,  # surface the real 5xx, not spotipy's generic 429
+                      allowed_methods=frozenset(["GET"]))
+))
+
+class SharedSessionSpotify(spotipy.Spotify):
+    # spotipy closes its session when a client is garbage collected, which
+    # would drop SPOTIFY_SESSION's pooled connections after every request
+    def __del__(self):
+        pass
+
+class Track(NamedTuple):
+    id: str
+    name: str
+    artists: str
+    primary_artist_id: str
+
+SP_OAUTH = SpotifyOAuth(
+    client_id=SPOTIPY_CLIENT_ID,
+    client_secret=SPOTIPY_CLIENT_SECRET,
+    redirect_uri=SPOTIPY_REDIRECT_URI,
+    scope=SCOPE,
+    # Tokens belong to the visitor's own session; a shared cache file would
+    # hand one user's cached token to the next person who logs in
+    cache_handler=FlaskSessionCacheHandler(session),
+    requests_session=SPOTIFY_SESSION
+)
+
+class NoCacheHandler(CacheHandler):
+    # Refreshes may run outside any request, where there is no session to
+    # save into; get_token stores the result itself
+    def get_cached_token(self):
+        return None
 
-def create_sp_oauth():
-    return SpotifyOAuth(
-        client_id=SPOTIPY_CLIENT_ID,
-        client_secret=SPOTIPY_CLIENT_SECRET,
-        redirect_uri=SPOTIPY_REDIRECT_URI,
-        scope=SCOPE,
-        cache_path=".spotify_token_cache"
-    )
+    def save_token_to_cache(self, token_info):
+        pass
+
+SP_OAUTH_REFRESH = SpotifyOAuth(
+    client_id=SPOTIPY_CLIENT_ID,
+    client_secret=SPOTIPY_CLIENT_SECRET,
+    redirect_uri=SPOTIPY_REDIRECT_URI,
+    scope=SCOPE,
+    cache_handler=NoCacheHandler(),
+    requests_session=SPOTIFY_SESSION
+)
+
+TOKEN_PREFETCH_SECONDS = 15 * 60  # refresh in the background once a token is this close to expiry
+TOKEN_REFRESH_LOCK = threading.Lock()
+
+# Refreshed tokens are published in the shared cache so every worker can adopt
+# them: "token:<sha256 of refresh_token>" -> token_info, kept until it expires
+def refreshed_token_key(refresh_token):
+    return f"token:{hashlib.sha256(refresh_token.encode()).hexdigest()}"
 
 def token_info_needs_refresh(token_info):
     now = int(time.time())
@@ -42,545 +150,354 @@ def get_token():
     token_info = session.get("token_info")
     if not token_info:
         return None
+    refresh_token = token_info["refresh_token"]
     if token_info_needs_refresh(token_info):
-        sp_oauth = create_sp_oauth()
-        refreshed = sp_oauth.refresh_access_token(token_info["refresh_token"])
+        refreshed = refresh_token_info(refresh_token, token_info.get("expires_at", 0))
+        # The refresh saves nowhere itself, and another worker may have done it
         session["token_info"] = refreshed
         return refreshed
+
+    if token_info.get("expires_at", 0) - time.time() < TOKEN_PREFETCH_SECONDS:
+        # Still valid: adopt a token a background refresh already fetched, or
+        # start one, so requests only wait on the token endpoint after expiry
+        refreshed = cache.get(refreshed_token_key(refresh_token))
+        if refreshed and refreshed.get("expires_at", 0) > token_info.get("expires_at", 0):
+            session["token_info"] = refreshed
+            return refreshed
+        run_in_background(refreshed_token_key(refresh_token), refresh_token_info, refresh_token, token_info.get("expires_at", 0))
     return token_info
 
+def refresh_token_info(refresh_token, expires_at):
+    # Double-checked under the lock: tabs reloading together near expiry share
+    # one call to Spotify's token endpoint instead of racing to refresh. Only a
+    # token newer than the caller's counts, or the next prefetch would get
+    # back the very token it is trying to replace.
+    key = refreshed_token_key(refresh_token)
+    with TOKEN_REFRESH_LOCK:
+        refreshed = cache.get(key)
+        if refreshed and refreshed.get("expires_at", 0) > expires_at and not token_info_needs_refresh(refreshed):
+            return refreshed
+        refreshed = SP_OAUTH_REFRESH.refresh_access_token(refresh_token)
+        cache.set(key, refreshed, timeout=max(1, int(refreshed.get("expires_at", 0) - time.time())))
+        return refreshed
+
 def ensure_spotify_client():
-    token_info = get_token()
-    if not token_info:
+    # One client per request, built lazily on first use
+    if "sp" not in g:
+        token_info = get_token()
+        g.sp = token_info and SharedSessionSpotify(
+            auth=token_info["access_token"], requests_session=SPOTIFY_SESSION
+        )
+    return g.sp
+
+class RateLimiter:
+    # Token bucket shared by every thread in the process: allows short bursts
+    # up to `capacity`, then spaces calls out to `rate` per second.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+SPOTIFY_RATE_LIMITER = RateLimiter(rate=10, capacity=10)
+
+# Shared by all requests, so page fetches in flight stay capped at
+# FETCH_WORKERS per process however many users are previewing at once
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="spotify-fetch")
+
+def call_spotify(fn, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        SPOTIFY_RATE_LIMITER.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            retry_after = int((e.headers or {}).get("Retry-After", 0)) if e.http_status == 429 else 0
+            # Don't park a worker for a long Retry-After; let the user try again later
+            if e.http_status != 429 or attempt == MAX_RETRIES or retry_after > MAX_BACKOFF_SECONDS:
+                raise
+            delay = max(retry_after, min(2 ** attempt, MAX_BACKOFF_SECONDS))
+            log.warning("⏳ Rate limited by Spotify, retrying in %ss", delay)
+            time.sleep(delay)
+
+def get_user_id(sp):
+    user_id = session.get("user_id")
+    if not user_id:
+        user_id = call_spotify(sp.current_user)["id"]
+        session["user_id"] = user_id
+    return user_id
+
+# Stored as orjson bytes rather than a pickled dict, which encodes thousands
+# of tracks far faster; the cache backend only ever wraps a single bytes value.
+def load_liked_songs_cache(user_id):
+    raw = cache.get(f"{user_id}:liked_tracks")
+    if not isinstance(raw, bytes):
         return None
-    return spotipy.Spotify(auth=token_info["access_token"])
-
-def fetch_random_liked_songs(sp, batch_size=500):
-    global CACHED_RANDOM_BATCH, CACHED_RANDOM_TIMESTAMP
+    library = orjson.loads(raw)
+    library["tracks"] = {
+        int(i): t and Track(t[0], t[1], sys.intern(t[2]), sys.intern(t[3]))
+        for i, t in library["tracks"].items()
+    }
+    return library
+
+def save_liked_songs_cache(user_id, library):
+    # orjson skips tuple subclasses by design, so Track goes through default=tuple
+    raw = orjson.dumps(library, default=tuple, option=orjson.OPT_NON_STR_KEYS)
+    cache.set(f"{user_id}:liked_tracks", raw, timeout=LIKED_SONGS_CACHE_TIMEOUT)
+
+def fetch_saved_tracks_page(sp, offset, limit):
+    return parse_saved_tracks(call_spotify(sp.current_user_saved_tracks, limit=limit, offset=offset))
+
+def parse_saved_tracks(results):
+    tracks = []
+    for item in results.get("items", []):
+        # Spotify always sends these keys, so index directly and treat a
+        # structurally broken item like a missing track
+        try:
+            t = item["track"]
+            track_id, name, artist_list = t["id"], t["name"], t["artists"]
+        except (KeyError, TypeError):
+            tracks.append(None)
+            continue
+        # Names can be null (e.g. on local files), which must not drop the track
+        artists = sys.intern(", ".join(a.get("name") or "" for a in artist_list))
+        # Local files have no artist id; their names stand in as the dedup key
+        primary_artist_id = sys.intern((artist_list and artist_list[0].get("id")) or artists)
+        tracks.append(Track(track_id, name, artists, primary_artist_id))
+    return tracks
 
+def revalidate_liked_songs_cache(sp, user_id):
+    # Returns (library, probed); a library checked within the last minute is
+    # trusted as is, so quick reshuffles don't pay for the total probe
+    library = load_liked_songs_cache(user_id)
     now = time.time()
-    if CACHED_RANDOM_BATCH and (now - CACHED_RANDOM_TIMESTAMP < CACHE_EXPIRY_SECONDS):
-        print("✅ Using cached random batch of liked songs")
-        return CACHED_RANDOM_BATCH
-
-    meta = sp.current_user_saved_tracks(limit=1)
-    total = meta.get("total", 0) or 0
-
-    if total <= batch_size or total == 0:
+    if library and now - library.get("checked_at", 0) < CACHE_EXPIRY_SECONDS:
+        return library, False
+
+    # The probe asks for a full first page: it costs the same round trip as
+    # limit=1 and leaves the newest saved tracks cached for free
+    first_page = call_spotify(sp.current_user_saved_tracks, limit=PAGE_SIZE)
+    total = first_page.get("total", 0) or 0
+
+    # Positions shift whenever the library changes, so a new total invalidates everything
+    if not library or library["total"] != total:
+        library = {"total": total, "tracks": {}}
+    library["tracks"].update(enumerate(parse_saved_tracks(first_page)))
+    library["checked_at"] = now
+    return library, True
+
+def fill_liked_songs_cache(sp, library, pages):
+    known = library["tracks"]
+    for (o, _), page in zip(pages, FETCH_EXECUTOR.map(lambda p: fetch_saved_tracks_page(sp, *p), pages)):
+        for i, t in enumerate(page):
+            known[o + i] = t
+
+def missing_pages(known, start, stop):
+    return [
+        (o, min(PAGE_SIZE, stop - o))
+        for o in range(start, stop, PAGE_SIZE)
+        if any(i not in known for i in range(o, min(o + PAGE_SIZE, stop)))
+    ]
+
+def fill_whole_library(sp, user_id):
+    library, _ = revalidate_liked_songs_cache(sp, user_id)
+    pages = missing_pages(library["tracks"], 0, library["total"])
+    if not pages:
+        return
+    # One page at a time on this thread, paced well under the rate limit and
+    # kept off FETCH_EXECUTOR, so previews never queue behind a big library
+    fetched = {}
+    for o, limit in pages:
+        for i, t in enumerate(fetch_saved_tracks_page(sp, o, limit)):
+            fetched[o + i] = t
+        time.sleep(BACKGROUND_FILL_INTERVAL)
+
+    # Previews kept writing while this ran, so merge into the latest entry
+    # instead of saving the snapshot; a new total means these positions are stale
+    latest = load_liked_songs_cache(user_id)
+    if not latest or latest["total"] != library["total"]:
+        log.info("Dropped liked songs fill: library changed while it ran")
+        return
+    latest["tracks"].update(fetched)
+    save_liked_songs_cache(user_id, latest)
+    log.info("💾 Cached all %d liked songs", latest["total"])
+
+def refresh_random_window(sp, user_id, batch_size):
+    library, _ = revalidate_liked_songs_cache(sp, user_id)
+    total = library["total"]
+    known = library["tracks"]
+
+    if len(known) >= total:
+        # Whole library cached: draw from all of it instead of a window
+        offset = 0
+        limit = total
+    elif total <= batch_size or total == 0:
         offset = 0
         limit = min(batch_size, total if total > 0 else 50)
     else:
         offset = random.randint(0, total - batch_size)
         limit = batch_size
 
-    print(f"Fetching {limit} liked songs starting at offset {offset} of {total}")
-
-    tracks = []
-    fetched = 0
-    while fetched < limit:
-        batch = min(50, limit - fetched)
-        results = sp.current_user_saved_tracks(limit=batch, offset=offset + fetched)
-        for item in results.get("items", []):
-            t = item.get("track")
-            if not t:
-                continue
-            artists = ", ".join([a.get("name", "") for a in t.get("artists", [])])
-            tracks.append({
-                "id": t.get("id"),
-                "name": t.get("name"),
-                "artists": artists
-            })
-        fetched += batch
-
-    CACHED_RANDOM_BATCH = tracks
-    CACHED_RANDOM_TIMESTAMP = now
-    print("💾 Cached random batch for next 1 minute")
-
-    return tracks
-
-# ---------- HTML Templates ----------
-INDEX_HTML = """
-<!doctype html>
-<html lang="en">
-<head>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<title>Random Spotify Playlist</title>
-<style>
-body {font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",sans-serif;
-      background:#121212;color:#fff;text-align:center;margin:0;padding:20px;}
-.container{max-width:400px;margin:auto;}
-button,input[type=number]{font-size:1.1em;border-radius:10px;padding:10px 16px;margin-top:12px;border:none;}
-button{background-color:#1DB954;color:white;cursor:pointer;}
-button:hover{background-color:#1ed760;}
-input[type=number]{width:60%;max-width:180px;text-align:center;}
-a{color:#1DB954;text-decoration:none;}
-#loader{display:none;flex-direction:column;align-items:center;justify-content:center;margin:15px 0;}
-.spinner{width:80px;height:80px;border:6px solid rgba(255,255,255,0.15);border-top:6px solid #1DB954;
-         border-radius:50%;animation:spin 1s linear infinite;display:flex;align-items:center;justify-content:center;margin-bottom:10px;}
-@keyframes spin{0%{transform:rotate(0deg);}100%{transform:rotate(360deg);}}
-.note{font-size:36px;color:#1DB954;animation:bounce 1.5s ease-in-out infinite;}
-@keyframes bounce{0%,100%{transform:translateY(0);}50%{transform:translateY(-6px);}}
-</style>
-</head>
-<body>
-<div class="container">
-  <h2>🎵 Random Playlist Generator</h2>
-  <div id="loader">
-    <div class="spinner"><div class="note">🎶</div></div>
-    <p style="margin-top:5px;color:#1DB954;font-size:0.9em;">Fetching songs...</p>
-  </div>
-  {% if not logged_in %}
-    <p>Sign in to Spotify to begin.</p>
-    <a href="{{ url_for('login') }}"><button>Sign in with Spotify</button></a>
-  {% else %}
-    <form id="previewForm" action="{{ url_for('preview') }}" method="post">
-      <label>Number of songs:</label><br>
-      <input type="number" name="size" min="1" value="10" required><br>
-      <button type="submit">Create Preview</button>
-    </form>
-    <p style="margin-top:20px;"><a href="{{ url_for('logout') }}">Log out</a></p>
-  {% endif %}
-</div>
-<script>
-document.addEventListener("DOMContentLoaded", function(){
-  const form=document.getElementById("previewForm");
-  const loader=document.getElementById("loader");
-  if(form&&loader){form.addEventListener("submit",function(){loader.style.display="flex";});}
-});
-</script>
-</body>
-</html>
-"""
-
-PREVIEW_HTML = """
-<!doctype html>
-<html lang="en">
-<head>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<title>Preview</title>
-<style>
-body{
-  font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",sans-serif;
-  background:#121212;color:#fff;text-align:center;margin:0;padding:20px;
-}
-.container{max-width:400px;margin:auto;}
-table{width:100%;border-collapse:collapse;margin-top:15px;}
-th,td{padding:8px 6px;border-bottom:1px solid #333;text-align:left;font-size:0.9em;}
-th{color:#1DB954;text-transform:uppercase;font-size:0.8em;}
-button{display:block;width:100%;margin:10px 0;padding:12px;font-size:1.1em;
-       border:none;border-radius:10px;cursor:pointer;}
-.save{background-color:#1DB954;color:white;}
-.save:hover{background-color:#1ed760;}
-.reshuffle{background-color:#333;color:#1DB954;border:1px solid #1DB954;}
-.reshuffle:hover{background-color:#1DB954;color:white;}
-
-/* Loader styling */
-#loader {
-  display:none;
-  flex-direction:column;
-  align-items:center;
-  justify-content:center;
-  margin:20px 0;
-}
-.spinner {
-  width:70px;height:70px;
-  border:6px solid rgba(255,255,255,0.15);
-  border-top:6px solid #1DB954;
-  border-radius:50%;
-  animation:spin 1s linear infinite;
-  display:flex;
-  align-items:center;
-  justify-content:center;
-  margin-bottom:10px;
-}
-@keyframes spin {
-  0% {transform:rotate(0deg);}
-  100% {transform:rotate(360deg);}
-}
-.note {
-  font-size:26px;
-  color:#1DB954;
-  animation:bounce 1.5s ease-in-out infinite;
-}
-@keyframes bounce {
-  0%,100% {transform:translateY(0);}
-  50% {transform:translateY(-6px);}
-}
-</style>
-</head>
-<body>
-<div class="container">
-  <h2>🎶 Preview: {{ count }} Songs</h2>
-
-  <!-- Loader -->
-  <div id="loader">
-    <div class="spinner"><div class="note">🎵</div></div>
-    <p id="loader-text" style="color:#1DB954;font-size:0.9em;">Loading...</p>
-  </div>
-
-  <table>
-    <tr><th>Song</th><th>Artist</th></tr>
-    {% for t in tracks %}
-      <tr><td>{{ t.name }}</td><td>{{ t.artists }}</td></tr>
-    {% endfor %}
-  </table>
-
-  <form id="saveForm" action="{{ url_for('create_playlist') }}" method="post">
-    <button type="submit" class="save">💾 Save Playlist</button>
-  </form>
-
-  <form id="reshuffleForm" action="{{ url_for('preview') }}" method="post">
-    <input type="hidden" name="size" value="{{ count }}">
-    <button type="submit" class="reshuffle">🔀 Reshuffle</button>
-  </form>
-
-  <p><a href="{{ url_for('index') }}" style="color:#1DB954;">⬅️ Back</a></p>
-</div>
-
-<script>
-document.addEventListener("DOMContentLoaded", function(){
-  const loader = document.getElementById("loader");
-  const loaderText = document.getElementById("loader-text");
-  const reshuffleForm = document.getElementById("reshuffleForm");
-  const saveForm = document.getElementById("saveForm");
-
-  // Show spinner for reshuffle
-  if(reshuffleForm && loader){
-    reshuffleForm.addEventListener("submit", function(){
-      loader.style.display = "flex";
-      loaderText.textContent = "Reshuffling songs...";
-    });
-  }
-
-  // Show spinner for saving playlist
-  if(saveForm && loader){
-    saveForm.addEventListener("submit", function(){
-      loader.style.display = "flex";
-      loaderText.textContent = "Saving to Spotify...";
-    });
-  }
-});
-</script>
-</body>
-</html>
-"""
-
-SAVE_FORM_HTML = """
-<!doctype html>
-<html lang="en">
-<head>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<title>Save Playlist</title>
-<style>
-body{
-  font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",sans-serif;
-  background:#121212;color:#fff;text-align:center;margin:0;padding:20px;
-}
-.container{max-width:420px;margin:auto;}
-.input-wrap{
-  position:relative; 
-  display:inline-block; 
-  width:100%; 
-  max-width:420px; 
-  margin-top:10px; 
-  margin-bottom:16px;
-}
-input[type=text]{
-  width:100%;
-  padding:10px;
-  padding-right:40px; /* space for circular x */
-  font-size:1em;
-  border-radius:8px;
-  border:none;
-  box-sizing:border-box;
-}
-.clear-x{
-  position:absolute;
-  right:10px;
-  top:50%;
-  transform:translateY(-50%);
-  cursor:pointer;
-  color:#000;
-  font-weight:bold;
-  background:#fff;
-  border:2px solid #000;
-  border-radius:50%;
-  width:22px;
-  height:22px;
-  display:flex;
-  align-items:center;
-  justify-content:center;
-  font-size:14px;
-  user-select:none;
-}
-.clear-x:hover{
-  background:#000;
-  color:#fff;
-}
-.radio-group{
-  display:flex;justify-content:center;gap:20px;margin-bottom:20px;
-}
-label{font-size:1em;cursor:pointer;}
-button{
-  width:100%;padding:12px;font-size:1.1em;border:none;border-radius:10px;
-  background-color:#1DB954;color:white;cursor:pointer;
-}
-button:hover{background-color:#1ed760;}
-
-/* Loader styling */
-#loader {
-  display:none;
-  flex-direction:column;
-  align-items:center;
-  justify-content:center;
-  margin:20px 0;
-}
-.spinner {
-  width:70px;height:70px;
-  border:6px solid rgba(255,255,255,0.15);
-  border-top:6px solid #1DB954;
-  border-radius:50%;
-  animation:spin 1s linear infinite;
-  display:flex;
-  align-items:center;
-  justify-content:center;
-  margin-bottom:10px;
-}
-@keyframes spin {
-  0% {transform:rotate(0deg);}
-  100% {transform:rotate(360deg);}
-}
-.note {
-  font-size:26px;
-  color:#1DB954;
-  animation:bounce 1.5s ease-in-out infinite;
-}
-@keyframes bounce {
-  0%,100% {transform:translateY(0);}
-  50% {transform:translateY(-6px);}
-}
-</style>
-</head>
-<body>
-<div class="container">
-  <h2>💾 Save Playlist</h2>
-
-  <!-- Spinner loader (hidden by default) -->
-  <div id="loader">
-    <div class="spinner"><div class="note">🎵</div></div>
-    <p style="color:#1DB954;font-size:0.9em;">Saving to Spotify...</p>
-  </div>
-
-  <form id="saveForm" action="{{ url_for('confirm_save_playlist') }}" method="post">
-    <label for="title">Playlist Title:</label><br>
-
-    <!-- Input with circular clear (x) button -->
-    <div class="input-wrap">
-      <input type="text" id="title" name="title" value="{{ suggested_title }}" required>
-      <span id="clearTitle" class="clear-x" aria-label="Clear title">x</span>
-    </div>
-
-    <div class="radio-group">
-      <label><input type="radio" name="privacy" value="private" checked> Save as Private</label>
-      <label><input type="radio" name="privacy" value="public"> Save as Public</label>
-    </div>
-
-    <button type="submit">Confirm Save</button>
-  </form>
-</div>
-
-<script>
-document.addEventListener("DOMContentLoaded", function(){
-  // Show spinner while saving
-  const form = document.getElementById("saveForm");
-  const loader = document.getElementById("loader");
-  if(form && loader){
-    form.addEventListener("submit", function(){
-      loader.style.display = "flex";
-    });
-  }
-
-  // Clear (x) logic
-  const clearBtn = document.getElementById("clearTitle");
-  const titleInput = document.getElementById("title");
-  if(clearBtn && titleInput){
-    clearBtn.addEventListener("click", function(){
-      titleInput.value = "";
-      titleInput.focus();
-    });
-  }
-});
-</script>
-</body>
-</html>
-"""
-
-SUCCESS_HTML = """
-<!doctype html>
-<html lang="en">
-<head>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<title>Playlist Created</title>
-<style>
-body {
-  font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",sans-serif;
-  background:#121212;color:#fff;text-align:center;
-  margin:0;padding:30px;
-}
-.container { max-width:420px; margin:0 auto; padding:0 16px; }
-a { color:#1DB954; text-decoration:none; word-wrap:break-word; overflow-wrap:break-word; }
-p { margin:12px 0; }
-.link-box {
-  background:#1e1e1e; padding:12px; border-radius:10px; text-align:left;
-  word-wrap:break-word; overflow-wrap:break-word;
-}
-
-/* Uniform button sizing */
-.btn, a.btn {
-  display:block;
-  width:100%;
-  padding:12px;
-  font-size:1.05em;
-  border:none;              /* ✅ removed green outline */
-  border-radius:10px;
-  cursor:pointer;
-  margin-top:12px;
-  text-align:center;
-  box-sizing:border-box;
-}
-.btn-main { background-color:#1DB954; color:#fff; }
-.btn-alt  { background-color:#333; color:#1DB954; }
-.btn:hover, a.btn:hover { opacity:0.9; }
-
-.share-row { margin-top:20px; }
-#qrcode {
-  margin-top:20px;
-  display:flex;
-  justify-content:center;
-}
-.hidden-input { position:absolute; left:-9999px; }
-</style>
-</head>
-<body>
-<div class="container">
-  <h2>✅ Playlist Created!</h2>
-  <p>Open on Spotify:</p>
-  <div class="link-box">
-    <a id="playlistLink" href="{{ url }}" target="_blank" rel="noopener">{{ url }}</a>
-  </div>
-
-  <h3 class="share-row">Share This Playlist</h3>
-
-  <!-- Copy -->
-  <button class="btn btn-alt" id="copyBtn">🔗 Copy Link</button>
-
-  <!-- Text / Email / WhatsApp share -->
-  <a class="btn btn-alt" id="smsLink"
-     href="sms:?&body={{ ('Check out my new Spotify playlist! 🎶 ' ~ url)|urlencode }}">
-     💬 Share via Text
-  </a>
-
-  <a class="btn btn-alt" id="emailLink"
-     href="mailto:?subject={{ ('My Spotify Playlist 🎧')|urlencode }}&body={{ ('Hey, check out this Spotify playlist I just made:' ~ '\\n\\n' ~ url)|urlencode }}">
-     ✉️ Share via Email
-  </a>
-
-  <a class="btn btn-alt" id="waLink"
-     target="_blank" rel="noopener"
-     href="https://wa.me/?text={{ ('Check out my new Spotify playlist! 🎶 ' ~ url)|urlencode }}">
-     🟢 Share via WhatsApp
-  </a>
-
-  <!-- QR Code -->
-  <button class="btn btn-alt" id="qrBtn">📱 Generate QR Code</button>
-  <div id="qrcode"></div>
-
-  <a href="{{ url_for('index') }}" class="btn btn-main">🎵 Create Another</a>
-
-  <input id="hiddenUrl" class="hidden-input" type="text" value="{{ url }}">
-</div>
-
-<script>
-(function(){
-  const url = "{{ url }}";
-  const copyBtn = document.getElementById('copyBtn');
-  const hiddenUrl = document.getElementById('hiddenUrl');
-  const qrBtn = document.getElementById('qrBtn');
-  const qrContainer = document.getElementById('qrcode');
-
-  if (copyBtn) {
-    copyBtn.addEventListener('click', async function() {
-      try {
-        if (navigator.clipboard && window.isSecureContext) {
-          await navigator.clipboard.writeText(url);
-        } else {
-          hiddenUrl.value = url;
-          hiddenUrl.select();
-          hiddenUrl.setSelectionRange(0, 99999);
-          document.execCommand('copy');
-        }
-        alert('✅ Link copied to clipboard!');
-      } catch (e) {
-        window.prompt('Copy this link:', url);
-      }
-    });
-  }
-
-  function loadQrLib(cb){
-    if (window.QRCode) return cb();
-    const s = document.createElement('script');
-    s.src = 'https://cdn.jsdelivr.net/npm/qrcodejs@1.0.0/qrcode.min.js';
-    s.onload = cb;
-    s.onerror = function(){
-      alert('Could not load QR library. Please try again.');
-    };
-    document.body.appendChild(s);
-  }
-
-  if (qrBtn) {
-    qrBtn.addEventListener('click', function(){
-      loadQrLib(function(){
-        qrContainer.innerHTML = '';
-        new QRCode(qrContainer, {
-          text: url,
-          width: 180,
-          height: 180,
-          colorDark: "#1DB954",
-          colorLight: "#121212"
-        });
-        qrContainer.scrollIntoView({ behavior: 'smooth', block: 'center' });
-      });
-    });
-  }
-})();
-</script>
-</body>
-</html>
-"""
+    pages = missing_pages(known, offset, min(offset + limit, total))
+    log.debug("Fetching %d pages of liked songs for offset %d of %d", len(pages), offset, total)
+    fill_liked_songs_cache(sp, library, pages)
+
+    # Keep one track per artist once per batch, so reshuffles only sample.
+    # Each artist's track is reservoir-sampled in the same pass, so it is
+    # uniform over their tracks rather than always the first one seen.
+    picks = {}  # primary_artist_id -> [position, tracks seen]
+    for i in range(offset, offset + limit):
+        t = known.get(i)
+        if not t:
+            continue
+        pick = picks.get(t.primary_artist_id)
+        if pick is None:
+            picks[t.primary_artist_id] = [i, 1]
+        else:
+            pick[1] += 1
+            if random.randrange(pick[1]) == 0:
+                pick[0] = i
+    window = [i for i, _ in picks.values()]
+
+    library["unique_window"] = window
+    library["window_at"] = time.time()
+    save_liked_songs_cache(user_id, library)
+    log.debug("💾 Cached random batch for next 1 minute")
+
+    if len(known) < total:
+        # Load the rest once so later batches need no Spotify calls at all
+        run_in_background(f"{user_id}:library", fill_whole_library, sp, user_id)
+
+    return library
+
+def run_in_background(key, fn, *args):
+    # At most one job in flight per key, however many requests ask for it
+    lock = REFRESH_LOCKS.setdefault(key, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            log.exception("Background %s failed", fn.__name__)
+        finally:
+            REFRESH_LOCKS.pop(key, None)
+            lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+def fetch_random_liked_songs(sp, size, batch_size=500):
+    user_id = get_user_id(sp)
+    library = load_liked_songs_cache(user_id)
+
+    age = time.time() - library.get("window_at", 0) if library and library.get("unique_window") else None
+    if age is not None and age < CACHE_EXPIRY_SECONDS:
+        log.debug("✅ Using cached random batch of liked songs")
+    elif age is not None and age < STALE_WINDOW_SECONDS:
+        # Stale-while-revalidate: answer now, swap in a new batch for the next request
+        log.debug("Serving stale random batch while refreshing it")
+        run_in_background(f"{user_id}:window", refresh_random_window, sp, user_id, batch_size)
+    else:
+        library = refresh_random_window(sp, user_id, batch_size)
+
+    # Draw positions first so only the chosen tracks are ever listed
+    window = library["unique_window"]
+    return [library["tracks"][i] for i in random.sample(window, min(size, len(window)))]
+
+def fetch_sampled_liked_songs(sp, size):
+    # Uniform over the whole library and only fetches the tracks it needs.
+    # Positions that repeat an artist are topped up with fresh draws.
+    user_id = get_user_id(sp)
+    library, probed = revalidate_liked_songs_cache(sp, user_id)
+    known = library["tracks"]
+    total = library["total"]
+
+    selection = []
+    seen_artists = set()
+    drawn = set()
+    fetched = False
+    for _ in range(SAMPLE_ROUNDS):
+        need = min(size - len(selection), total - len(drawn))
+        if need <= 0:
+            break
+        positions = [p for p in random.sample(range(total), need + len(drawn)) if p not in drawn][:need]
+        drawn.update(positions)
+
+        missing = [(p, 1) for p in positions if p not in known]
+        if missing:
+            log.debug("Fetching %d sampled liked songs of %d", len(missing), total)
+            fill_liked_songs_cache(sp, library, missing)
+            fetched = True
+
+        for p in positions:
+            t = known.get(p)
+            if t and t.primary_artist_id not in seen_artists:
+                seen_artists.add(t.primary_artist_id)
+                selection.append(t)
+
+    if fetched or probed:
+        save_liked_songs_cache(user_id, library)
+    return selection
+
+@app.errorhandler(spotipy.SpotifyException)
+def spotify_error(e):
+    if e.http_status == 429:
+        return "Spotify is busy right now. Please try again in a minute.", 503
+    return f"Spotify request failed: {e.msg}", 502
+
+# The landing page only varies by login state, so each variant is rendered
+# once per process and then served as plain bytes without touching Jinja.
+# logged_in -> (page bytes, etag)
+INDEX_PAGES = {}
 
 @app.route("/")
 def index():
     logged_in = get_token() is not None
-    return render_template_string(INDEX_HTML, logged_in=logged_in)
+    if logged_in not in INDEX_PAGES:
+        page = render_template("index.html", logged_in=logged_in).encode()
+        INDEX_PAGES[logged_in] = (page, hashlib.sha1(page).hexdigest())
+    page, etag = INDEX_PAGES[logged_in]
+
+    # Both variants share one URL, so browsers revalidate every load (a 304
+    # once the ETag matches) rather than keep a page from before a login
+    response = Response(page, mimetype="text/html")
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
 
 @app.route("/login")
 def login():
-    sp_oauth = create_sp_oauth()
-    return redirect(sp_oauth.get_authorize_url())
+    return redirect(SP_OAUTH.get_authorize_url())
 
 @app.route("/callback")
 def callback():
-    sp_oauth = create_sp_oauth()
     code = request.args.get("code")
     if not code:
         return "Missing code parameter", 400
-    token_info = sp_oauth.get_access_token(code)
-    session["token_info"] = token_info
+    token_info = SP_OAUTH.get_access_token(code, check_cache=False)  # saved to session["token_info"]
+    # The user id never changes for a login, so fetch it once here instead of per save
+    sp = SharedSessionSpotify(auth=token_info["access_token"], requests_session=SPOTIFY_SESSION)
+    session["user_id"] = call_spotify(sp.current_user)["id"]
     return redirect(url_for("index"))
 
 @app.route("/logout")
 def logout():
     session.pop("token_info", None)
+    session.pop("user_id", None)
     return redirect(url_for("index"))
 
 @app.route("/preview", methods=["POST"])
@@ -590,62 +507,131 @@ def preview():
         return redirect(url_for("login"))
 
     size = int(request.form.get("size", 10))
-    songs = fetch_random_liked_songs(sp, batch_size=500)
-    if not songs:
+    # Both fetch paths return at most `size` tracks, one per artist, in random order
+    if size <= SAMPLE_BY_POSITION_MAX:
+        selection = fetch_sampled_liked_songs(sp, size)
+    else:
+        selection = fetch_random_liked_songs(sp, size, batch_size=500)
+    if not selection:
         return "No liked songs found."
 
-    unique_artists = {}
-    for s in songs:
-        artist = s["artists"]
-        if artist not in unique_artists:
-            unique_artists[artist] = s
-    filtered = list(unique_artists.values())
+    session["preview_ids"] = [s.id for s in selection]
 
-    selection = random.sample(filtered, min(size, len(filtered)))
-    session["preview_ids"] = [s["id"] for s in selection]
-
-    tracks_for_display = [{"name": s["name"], "artists": s["artists"]} for s in selection]
-    return render_template_string(PREVIEW_HTML, tracks=tracks_for_display, count=len(tracks_for_display))
+    # Streamed so large previews start sending rows before the whole table renders
+    return stream_template("preview.html", tracks=selection, count=len(selection))
 
 @app.route("/create_playlist", methods=["POST"])
 def create_playlist():
-    token = get_token()
-    if not token:
+    if not ensure_spotify_client():
         return redirect(url_for("login"))
-    sp = ensure_spotify_client()
     ids = session.get("preview_ids", [])
     if not ids:
         return "No previewed songs found. Preview first."
 
     # ✅ Generate suggested title and show the user a form
-    from datetime import datetime
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d")
     suggested_title = f"{today} 🎲 Random Playlist"
-    session["pending_ids"] = ids  # store temporarily until confirmed
-    return render_template_string(SAVE_FORM_HTML, suggested_title=suggested_title)
+    return render_template("save_form.html", suggested_title=suggested_title)
+
+def add_playlist_tracks(sp, ids, status, lock_key, status_key):
+    # Chunks are added one after another on purpose: concurrent appends land
+    # in arbitrary order, and an explicit position past the current end of
+    # the playlist is rejected if an earlier chunk hasn't landed yet.
+    # status["added"] is saved after every chunk so a retry resumes from there.
+    try:
+        for i in range(status["added"], len(ids), 100):
+            call_spotify(sp.playlist_add_items, status["playlist_id"], ids[i:i+100])
+            status["added"] = min(i + 100, len(ids))
+            cache.set(status_key, status, timeout=SAVE_STATUS_SECONDS)
+        status["state"] = "done"
+    except Exception:
+        # Lets the success page offer a retry instead of claiming a full playlist
+        status["state"] = "failed"
+        raise
+    finally:
+        cache.set(status_key, status, timeout=SAVE_STATUS_SECONDS)
+        cache.delete(lock_key)
 
 @app.route("/confirm_save_playlist", methods=["POST"])
 def confirm_save_playlist():
     sp = ensure_spotify_client()
-    ids = session.get("pending_ids", [])
+    ids = session.get("preview_ids", [])
     if not ids:
         return "No songs found to save."
 
     title = request.form.get("title", "Random Playlist")
     privacy = request.form.get("privacy", "private")
 
-    user = sp.current_user()
-    user_id = user.get("id")
-
-    try:
-        playlist = sp.user_playlist_create(user_id, title, public=(privacy == "public"))
-        for i in range(0, len(ids), 100):
-            sp.playlist_add_items(playlist["id"], ids[i:i+100])
-        playlist_url = playlist.get("external_urls", {}).get("spotify")
-        session.pop("pending_ids", None)
-        return render_template_string(SUCCESS_HTML, url=playlist_url)
-    except Exception as e:
-        return f"Failed to create playlist: {e}"
+    user_id = get_user_id(sp)
+    save_job = hashlib.sha1(",".join(ids).encode()).hexdigest()
+    # {"state": "running" | "done" | "failed", "playlist_id", "url", "added"}
+    status_key = f"save:{user_id}:{save_job}"
+    status = cache.get(status_key) or {}
+    if status.get("state") == "done":
+        session.pop("preview_ids", None)
+        return "This playlist was already saved."
+    if status.get("state") == "running":
+        return "Playlist is already being created, refresh in a moment."
+
+    # A double-clicked Save posts twice before either request clears
+    # preview_ids; only the first may create the playlist. The lock lasts as
+    # long as a background append may, and still expires on its own if a
+    # worker dies mid-save.
+    lock_key = f"lock:create:{user_id}:{save_job}"
+    if not cache.add(lock_key, 1, timeout=SAVE_STATUS_SECONDS):
+        return "Playlist is already being created, refresh in a moment."
+
+    if status.get("state") != "failed":
+        try:
+            playlist = call_spotify(sp.user_playlist_create, user_id, title, public=(privacy == "public"))
+            # The first chunk lands before answering so the link never opens an empty playlist
+            call_spotify(sp.playlist_add_items, playlist["id"], ids[:100])
+        except Exception as e:
+            cache.delete(lock_key)
+            return f"Failed to create playlist: {e}"
+        status = {
+            "playlist_id": playlist["id"],
+            "url": playlist.get("external_urls", {}).get("spotify"),
+            "added": min(100, len(ids)),
+        }
+    # else: a retry after a failed append resumes the half-filled playlist
+    # instead of leaving it behind and starting a new one
+
+    if status["added"] < len(ids):
+        # Big saves append the rest in the background instead of holding the
+        # request; the lock is kept until the last chunk lands, and preview_ids
+        # until save_status reports it done, so a failed save can be retried
+        status["state"] = "running"
+        cache.set(status_key, status, timeout=SAVE_STATUS_SECONDS)
+        run_in_background(lock_key, add_playlist_tracks, sp, ids, status, lock_key, status_key)
+    else:
+        cache.delete(lock_key)
+        save_job = None
+
+    if not save_job:
+        session.pop("preview_ids", None)
+    playlist_url = status["url"]
+    share_text = quote(f"Check out my new Spotify playlist! 🎶 {playlist_url}")
+    email_body = quote(f"Hey, check out this Spotify playlist I just made:\n\n{playlist_url}")
+    return render_template(
+        "success.html",
+        url=playlist_url,
+        share_text=share_text,
+        email_subject=SHARE_EMAIL_SUBJECT,
+        email_body=email_body,
+        save_job=save_job,
+    )
 
+@app.route("/save_status/<job>")
+def save_status(job):
+    # Polled by the success page while a big save finishes in the background
+    state = (cache.get(f"save:{session.get('user_id')}:{job}") or {}).get("state", "unknown")
+    # Only clear the preview this job saved, not a newer one from another tab
+    ids = session.get("preview_ids")
+    if state == "done" and ids and hashlib.sha1(",".join(ids).encode()).hexdigest() == job:
+        session.pop("preview_ids", None)
+    return jsonify(state=state)
+
+# Local debugging only; production runs under gunicorn (see Procfile)
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8888)))